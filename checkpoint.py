@@ -0,0 +1,122 @@
+"""Module for recording which build phases are complete, so a failed build can
+be resumed
+
+Each phase is identified by a key, which is a hash of the phase's inputs and
+of the key of the phase before it.  When a phase finishes, its key is
+written to a JSON file in the stage dir parent.  On resume, a phase is
+skipped if its recorded key matches the one computed now and its outputs
+still exist; the first phase that does not match, and every phase after it,
+is run again.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+from common import Error, Pathable
+
+CHECKPOINT_FILE = "checkpoints.json"
+
+# The phases of a build, in order
+PHASES = ["image", "export", "whiteouts", "extract", "patch", "debuginfo", "archive"]
+
+HashInput = Union[str, os.PathLike]
+
+
+def hash_inputs(*inputs: HashInput) -> str:
+    """
+    Return a hex digest of the given inputs.  Strings are hashed as they are;
+    paths are hashed by name and contents (a missing file hashes differently
+    than an empty one).
+    """
+    hasher = hashlib.sha256()
+    for item in inputs:
+        if isinstance(item, str):
+            hasher.update(b"s:" + item.encode() + b"\0")
+            continue
+        hasher.update(b"f:" + os.fsencode(item) + b"\0")
+        try:
+            with open(item, "rb") as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b""):
+                    hasher.update(chunk)
+        except FileNotFoundError:
+            hasher.update(b"\0missing\0")
+        except OSError as err:
+            raise Error(f"Unable to hash {item}: {err}") from err
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class Checkpoints:
+    def __init__(self, path: Optional[Pathable] = None, bundle="", dver=""):
+        """
+        Arguments:
+            path: The checkpoint file.  If it exists, the checkpoints in it
+                are loaded; if None, checkpoints are only kept in memory until
+                a path is set.
+            bundle, dver: Saved in the file so that a stage dir can be matched
+                up with the build it belongs to when resuming.
+        """
+        self.path = Path(path) if path else None
+        self.bundle = bundle
+        self.dver = dver
+        self.completed: dict[str, str] = {}
+        self._pending: dict[str, str] = {}
+        self._previous_key = ""
+        self._rerunning = False
+        if self.path and self.path.exists():
+            self.completed = self.read(self.path).get("completed", {})
+
+    @staticmethod
+    def read(path: Pathable) -> dict:
+        try:
+            with open(path, "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as err:
+            raise Error(f"Unable to read checkpoints from {path}: {err}") from err
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        data = {"bundle": self.bundle, "dver": self.dver, "completed": self.completed}
+        temp_path = self.path.with_name(self.path.name + ".new")
+        try:
+            with open(temp_path, "w") as fh:
+                json.dump(data, fh, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            raise Error(f"Unable to save checkpoints to {self.path}: {err}") from err
+
+    def needed(
+        self, phase: str, *inputs: HashInput, outputs: Sequence[Pathable] = ()
+    ) -> bool:
+        """
+        Return True if `phase` has to be run: it has not been completed with
+        the same inputs, some of its outputs are missing, or an earlier phase
+        is being run again.  Call done() once the phase has been run.
+        Phases must be checked in the order they appear in PHASES.
+        """
+        key = hash_inputs(self._previous_key, phase, *inputs)
+        self._previous_key = key
+        self._pending[phase] = key
+        if (
+            not self._rerunning
+            and self.completed.get(phase) == key
+            and all(os.path.exists(x) for x in outputs)
+        ):
+            return False
+        self.invalidate(phase)
+        return True
+
+    def done(self, phase: str) -> None:
+        self.completed[phase] = self._pending[phase]
+        self.save()
+
+    def invalidate(self, phase: str) -> None:
+        """Forget that `phase` and every phase after it were completed"""
+        self._rerunning = True
+        for later_phase in PHASES[PHASES.index(phase) :]:
+            self.completed.pop(later_phase, None)
+        self.save()
@@ -60,6 +60,24 @@ def to_bytes(strlike, encoding="latin-1", errors="backslashescape"):
         return strlike
 
 
+SIZE_SUFFIXES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size such as "512M" or "4G" (powers of 1024) into a number of
+    bytes.  A plain number is taken as bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)i?B?\s*", size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {size!r}")
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def format_size(num_bytes: int) -> str:
+    return f"{num_bytes / (1 << 20):,.1f} MiB"
+
+
 def sanitize_image_tag(image_tag: str) -> str:
     """
     Return the sanitized version of an image tag.
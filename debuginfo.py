@@ -0,0 +1,177 @@
+"""Module for stripping debug information from the ELF files in a stage dir
+
+There are two modes:
+
+- "strip": the symbol tables and debug sections are removed from each ELF file
+  that has a build-id, and saved in a separate debug file at
+  usr/lib/debug/.build-id/<xx>/<rest of build-id>.debug in a debuginfo tree.
+  The debuginfo tree is made into a companion tarball; extracting it over
+  the installed tarball lets gdb find the debug files by build-id.
+- "compress": the debug sections are compressed in place, which keeps
+  everything in the one tarball but saves less space.
+
+The files are processed in parallel, one objcopy per CPU.
+"""
+
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from common import Error, Pathable, safe_makedirs
+
+MODES = ["none", "strip", "compress"]
+
+ELF_MAGIC = b"\x7fELF"
+
+# Sections whose presence means there is something to strip
+DEBUG_SECTION_RE = re.compile(r"\s(\.symtab|\.z?debug_\w+)\s")
+
+BUILD_ID_RE = re.compile(r"Build ID:\s*([0-9a-f]+)")
+
+
+def debuginfo_tarball_name(tarball_name: str) -> str:
+    return re.sub(r"\.tar(\.gz)?$", "", tarball_name) + "-debuginfo.tar.gz"
+
+
+def is_elf(path: Pathable) -> bool:
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(4) == ELF_MAGIC
+    except OSError:
+        return False
+
+
+def find_elf_files(stage_dir_abs: Pathable) -> list[list[str]]:
+    """
+    Return the ELF files in the stage dir, grouped by inode: the first path in
+    each group is the one to process and the rest are hard links to it.
+    """
+    by_inode: dict[tuple[int, int], list[str]] = {}
+    for dirpath, _, filenames in os.walk(os.fspath(stage_dir_abs)):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            if not is_elf(path):
+                continue
+            st = os.stat(path)
+            by_inode.setdefault((st.st_dev, st.st_ino), []).append(path)
+    return [sorted(paths) for paths in by_inode.values()]
+
+
+def read_elf_info(path: Pathable) -> tuple[Optional[str], bool]:
+    """Return the build-id of an ELF file (or None) and whether it has debug info"""
+    try:
+        result = subprocess.run(
+            ["readelf", "--wide", "--section-headers", "--notes", os.fspath(path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise Error(f"Unable to read ELF headers of {path}: {err}") from err
+    output = result.stdout.decode(errors="replace")
+    match = BUILD_ID_RE.search(output)
+    return (match.group(1) if match else None), bool(DEBUG_SECTION_RE.search(output))
+
+
+def relink(paths: list[str]) -> None:
+    """
+    objcopy replaces the file it modifies, which breaks hard links; link the
+    other paths to the first one again.
+    """
+    for path in paths[1:]:
+        os.unlink(path)
+        os.link(paths[0], path)
+
+
+def strip_files(build_id: str, groups: list[list[str]], debug_dir_abs: str) -> int:
+    """
+    Move the debug information of the ELF files with the given build-id into
+    debug_dir_abs.  Separate copies of the same file share a build-id, so the
+    debug file is written once, from the first copy, and every copy is
+    stripped.  Return the number of files stripped.
+    """
+    debug_path = os.path.join(
+        debug_dir_abs, ".build-id", build_id[:2], build_id[2:] + ".debug"
+    )
+    safe_makedirs(os.path.dirname(debug_path))
+    path = groups[0][0]
+    try:
+        subprocess.run(
+            ["objcopy", "--only-keep-debug", path, debug_path],
+            check=True,
+            stderr=subprocess.PIPE,
+        )
+        for paths in groups:
+            path = paths[0]
+            subprocess.run(
+                ["objcopy", "--strip-unneeded", path],
+                check=True,
+                stderr=subprocess.PIPE,
+            )
+            relink(paths)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise Error(f"Unable to strip {path}: {err}") from err
+    return len(groups)
+
+
+def compress_file(paths: list[str]) -> bool:
+    """
+    Compress the debug sections of an ELF file in place.  Return True if the
+    file had debug sections.
+    """
+    path = paths[0]
+    _, has_debug = read_elf_info(path)
+    if not has_debug:
+        return False
+    try:
+        subprocess.run(
+            ["objcopy", "--compress-debug-sections=zlib", path],
+            check=True,
+            stderr=subprocess.PIPE,
+        )
+        relink(paths)
+    except (OSError, subprocess.CalledProcessError) as err:
+        raise Error(f"Unable to compress debug sections of {path}: {err}") from err
+    return True
+
+
+def process_stage_dir(
+    stage_dir_abs: Pathable, mode: str, debug_stage_dir_abs: Optional[Pathable] = None
+) -> int:
+    """
+    Strip or compress the debug information of every ELF file in the stage
+    dir.  In "strip" mode, the debug files are written under
+    usr/lib/debug in debug_stage_dir_abs.  Return the number of files changed.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Invalid debuginfo mode {mode!r}")
+    if mode == "none":
+        return 0
+
+    elf_files = find_elf_files(stage_dir_abs)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        if mode == "compress":
+            return sum(executor.map(compress_file, elf_files))
+
+        if not debug_stage_dir_abs:
+            raise ValueError("debug_stage_dir_abs is required to strip files")
+        debug_dir_abs = os.path.join(debug_stage_dir_abs, "usr", "lib", "debug")
+
+        # Group the files by build-id so that no two jobs write the same
+        # debug file
+        by_build_id: dict[str, list[list[str]]] = {}
+        elf_infos = executor.map(lambda paths: read_elf_info(paths[0]), elf_files)
+        for paths, (build_id, has_debug) in zip(elf_files, elf_infos):
+            if build_id and has_debug:
+                by_build_id.setdefault(build_id, []).append(paths)
+
+        return sum(
+            executor.map(
+                lambda item: strip_files(item[0], item[1], debug_dir_abs),
+                by_build_id.items(),
+            )
+        )
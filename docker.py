@@ -4,7 +4,8 @@ import shutil
 import subprocess
 import tarfile
 import tempfile
-from typing import Any, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence
 
 from common import Error, Pathable
 
@@ -26,6 +27,11 @@ VALUES_DVER = {
     },
 }
 
+# Which package owns each file, saved before the RPM database is deleted;
+# used for the size report and not shipped
+RPM_FILES_PATH = "portable-xrootd/.rpm-files"
+RPM_QUERYFORMAT = r"[%{NAME}\t%{VERSION}-%{RELEASE}\t%{FILENAMES}\n]"
+
 DOCKERFILE_TEMPLATE = r"""
 FROM {fromimage} AS {fromstagename}
 COPY {stage1file} /stage1.lst
@@ -46,11 +52,21 @@ RUN \
     yum install -y {flags} {packages} \
     && yum clean all \
     && rpm -q {packages} | sort > /portable-xrootd/versions.txt \
+    && rpm -qa --queryformat '{rpm_queryformat}' > /{rpm_files} \
     && xargs -d '\n' -a /paths-to-delete.txt rm -rf \
     && python3 /envsetup.py /portable-xrootd {dver} \
     && touch /portable-xrootd/*
 """
 
+# Added after the final stage to make an image for recording the startup
+# profile in: the same packages, but without the cleanup, so the users,
+# grid-security directories, and RPM database that xrootd and yum need are
+# still there.  Its layers up to the final stage are cached from the main build.
+TRACE_STAGE_TEMPLATE = r"""
+FROM {basename} AS {bundle}-{dver}-trace
+RUN yum install -y {flags} {packages} strace openssl
+"""
+
 
 class Docker:
     def __init__(self, executable=""):
@@ -77,13 +93,65 @@ class Docker:
         assert isinstance(self.executable, str)
         return subprocess.run([self.executable] + list(args), **kwargs)
 
+    def output(self, *args, input: Optional[str] = None) -> str:
+        """
+        Run a docker command and return its stdout, stripped.  `input`, if
+        given, is passed to its stdin.  Raises Error if the command could not
+        be run or failed.
+        """
+        try:
+            result = self.do(
+                *args,
+                stdout=subprocess.PIPE,
+                check=True,
+                input=input.encode() if input is not None else None,
+            )
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise Error(f"'{' '.join(args)}' failed: {err}") from err
+        return result.stdout.decode().strip()
+
+    def image_id(self, image: str) -> str:
+        """Return the ID of an image; raises Error if it does not exist."""
+        return self.output("image", "inspect", "--format", "{{.Id}}", image)
+
+    def image_size(self, image: str) -> int:
+        """
+        Return the total (uncompressed) size of an image in bytes; this is
+        about how large the output of `docker save` will be.
+        """
+        try:
+            return int(self.output("image", "inspect", "--format", "{{.Size}}", image))
+        except ValueError as err:
+            raise Error(f"Could not get the size of image {image}: {err}") from err
+
+    def top_layer_size(self, image: str) -> int:
+        """
+        Return the size in bytes of the topmost layer of an image, i.e. the
+        layer that extract_top_layer() will save.
+        """
+        history = self.output(
+            "history", "--human=false", "--no-trunc", "--format", "{{.Size}}", image
+        )
+        try:
+            return int(history.splitlines()[0])
+        except (IndexError, ValueError) as err:
+            raise Error(
+                f"Could not get the size of the top layer of {image}: {err}"
+            ) from err
+
 
 def render_dockerfile(
     bundlecfg: Mapping[str, Mapping[str, Any]],
     bundle: str,
     dver: str,
     flags: Sequence[str] = (),
+    trace: bool = False,
 ):
+    """
+    Return the Dockerfile for the bundle.  If `trace` is set, the final stage
+    is the one to record the startup profile in instead (see
+    TRACE_STAGE_TEMPLATE).
+    """
     values = dict()
     values.update(VALUES_DVER[dver])
     values["bundle"] = bundle
@@ -92,14 +160,37 @@ def render_dockerfile(
         "stage1", bundlecfg[bundle]["stage1file"] % {"dver": dver}
     )
     values["packages"] = " ".join(bundlecfg[bundle]["packages"].split())
+    values["rpm_files"] = RPM_FILES_PATH
+    values["rpm_queryformat"] = RPM_QUERYFORMAT
     if isinstance(flags, str):  # str is a sequence of str
         values["flags"] = flags
     else:
         values["flags"] = " ".join(flags)
-    return DOCKERFILE_TEMPLATE.format(**values)
+    dockerfile = DOCKERFILE_TEMPLATE.format(**values)
+    if trace:
+        dockerfile += TRACE_STAGE_TEMPLATE.format(**values)
+    return dockerfile
 
 
-def extract_top_layer(image: str, destpath: Pathable) -> None:
+def build_context_files(
+    bundlecfg: Mapping[str, Mapping[str, Any]],
+    bundle: str,
+    dver: str,
+) -> list[Path]:
+    """
+    Return the files from the build context that the Dockerfile for the
+    bundle copies into the image.
+    """
+    return [
+        Path("stage1", bundlecfg[bundle]["stage1file"] % {"dver": dver}),
+        Path("stage1", "paths-to-delete.txt"),
+        Path("envsetup.py"),
+    ] + sorted(Path("post-install").glob("*"))
+
+
+def extract_top_layer(
+    image: str, destpath: Pathable, export_dir: Optional[Pathable] = None
+) -> None:
     """
     Takes the name of an image as an input and extracts the topmost layer
     of the image, saving it to destpath.  A layer of an image is an
@@ -109,14 +200,20 @@ def extract_top_layer(image: str, destpath: Pathable) -> None:
     Arguments:
         image: The name of the image to extract the topmost layer from.
         destpath: The path to save the extracted layer to.
+        export_dir: The directory to export the whole image into while the
+            layer is being extracted; it needs room for the entire image.
+            If not specified, a directory under /var/tmp is used.
 
     Returns:
         None
     """
     docker = Docker()
-    tempdir = tempfile.gettempdir()
-    if tempdir == "/tmp":
-        tempdir = "/var/tmp"  # /var/tmp is bigger
+    if export_dir:
+        tempdir = str(export_dir)
+    else:
+        tempdir = tempfile.gettempdir()
+        if tempdir == "/tmp":
+            tempdir = "/var/tmp"  # /var/tmp is bigger
 
     with tempfile.TemporaryDirectory(prefix="portabletmp", dir=tempdir) as workdir:
         image_path = os.path.join(workdir, "image.tar")
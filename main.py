@@ -5,9 +5,7 @@ import shlex
 import shutil
 import subprocess
 import sys
-import tempfile
 from optparse import OptionParser
-from pathlib import Path
 from typing import Optional
 
 # make sure we can find our imports
@@ -15,12 +13,19 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 
+import checkpoint
+import debuginfo
 import docker
+import sizereport
 import stage2
+import staging
+import startupprofile
 from common import (
     VALID_DVERS,
     Error,
     errormsg,
+    format_size,
+    parse_size,
     sanitize_image_tag,
     statusmsg,
     to_str,
@@ -29,9 +34,12 @@ from common import (
 BUNDLES_FILE = 'bundles.ini'
 
 
-def check_tools():
+def check_tools(debuginfo_mode="none"):
     ret = True
-    for tool in ["docker", "tar"]:
+    tools = ["docker", "tar"]
+    if debuginfo_mode != "none":
+        tools += ["objcopy", "readelf"]
+    for tool in tools:
         if not shutil.which(tool):
             errormsg("Required executable '%s' not found" % tool)
             ret = False
@@ -45,14 +53,33 @@ def make_tarball(
     dver: str,
     image_name: str,
     patch_dirs,
-    stage_dir: Path,
+    stager: staging.StagingManager,
+    job: staging.StageJob,
     osg_repo: str,
     relnum="0",
     version=None,
+    compare_dir=None,
+    debuginfo_mode="none",
+    startup_profile=None,
+    record_startup_profile=False,
+    seekable_output=False,
 ):
     """Run all the steps to make a non-root tarball.
     Returns (success (bool), tarball_path (relative), tarball_size (in bytes))
 
+    The stage dir for the job is placed by `stager` once the image has been
+    built; raises staging.InsufficientSpaceError if there is no room for it.
+    If the job already has a stage dir (it is being resumed), the phases
+    recorded as complete in its checkpoint file are skipped.
+
+    A size report is written next to the tarball and compared against the
+    latest report for the same bundle and dver in `compare_dir`.  The build
+    fails if the tarball is larger than the bundle's size_budget.
+
+    If record_startup_profile is set, xrootd is traced starting in an image
+    built from the trace stage of the Dockerfile, and the files it opens are
+    written to `startup_profile`.  If `startup_profile` is set, the tarball
+    members are ordered by it.
     """
     if osg_repo in ["production", "osg"]:
         extra_repos = []
@@ -72,18 +99,99 @@ def make_tarball(
         dver=dver,
         flags=flags,
     )
+    checkpoints = checkpoint.Checkpoints(
+        job.path / checkpoint.CHECKPOINT_FILE if job.path else None,
+        bundle=bundle,
+        dver=dver,
+    )
     try:
-        doc.build(dockerfile, image_name)
-    except (OSError, subprocess.CalledProcessError) as err:
-        errormsg(f"Failed to build Docker image: {err}")
-        return (False, None, 0)
-
-    stage_dir.mkdir(parents=True, exist_ok=True)
-    layer_tarball_path = stage_dir / "layer.tar"
-    try:
-        docker.extract_top_layer(image_name, layer_tarball_path)
+        try:
+            doc.image_id(image_name)
+        except Error:
+            checkpoints.invalidate("image")
+        if checkpoints.needed(
+            "image",
+            dockerfile,
+            *docker.build_context_files(bundlecfg=bundlecfg, bundle=bundle, dver=dver),
+        ):
+            try:
+                doc.build(dockerfile, image_name)
+            except (OSError, subprocess.CalledProcessError) as err:
+                errormsg(f"Failed to build Docker image: {err}")
+                return (False, None, 0)
+            checkpoints.done("image")
+        else:
+            statusmsg(f"Skipping building image: already built as {image_name}")
+
+        if record_startup_profile and startup_profile:
+            # The image is cleaned up too much to start xrootd in, so trace
+            # it in one from before the cleanup
+            trace_image_name = image_name + "-trace"
+            statusmsg(f"Building {trace_image_name} to record the startup profile")
+            try:
+                doc.build(
+                    docker.render_dockerfile(
+                        bundlecfg=bundlecfg,
+                        bundle=bundle,
+                        dver=dver,
+                        flags=flags,
+                        trace=True,
+                    ),
+                    trace_image_name,
+                )
+            except (OSError, subprocess.CalledProcessError) as err:
+                errormsg(f"Failed to build Docker image: {err}")
+                return (False, None, 0)
+            statusmsg(f"Recording startup profile into {startup_profile}")
+            try:
+                profile = startupprofile.record_startup_profile(trace_image_name)
+            finally:
+                doc.do("rmi", trace_image_name)
+            startupprofile.write_profile(profile, startup_profile, trace_image_name)
+
+        if not job.path:
+            try:
+                estimate = stager.estimate(image_name)
+            except Error as err:
+                errormsg(f"Failed to estimate the space needed: {err}")
+                return (False, None, 0)
+            try:
+                stager.place(job, estimate)
+            except staging.InsufficientSpaceError:
+                # Don't hold on to the image's disk space while the job waits
+                # to be retried (or after it has been refused)
+                doc.do("rmi", image_name)
+                raise
+            assert job.path is not None
+            statusmsg(
+                f"Staging in {job.path} ({'tmpfs' if job.on_tmpfs else 'disk'}, "
+                f"top layer is {format_size(estimate.layer_bytes)})"
+            )
+            checkpoints.path = job.path / checkpoint.CHECKPOINT_FILE
+            checkpoints.save()
+        else:
+            statusmsg(f"Resuming in {job.path}")
+
+        stage_dir = job.path / bundlecfg[bundle]["dirname"]
+        stage_dir.mkdir(parents=True, exist_ok=True)
+        layer_tarball_path = stage_dir / "layer.tar"
+        if checkpoints.needed(
+            "export", doc.image_id(image_name), outputs=[layer_tarball_path]
+        ):
+            try:
+                docker.extract_top_layer(
+                    image_name, layer_tarball_path, export_dir=job.export_dir
+                )
+            except Error as err:
+                errormsg(f"Failed to extract top layer: {err}")
+                return (False, None, 0)
+            checkpoints.done("export")
+        else:
+            statusmsg("Skipping extracting top layer: already done")
+    except staging.InsufficientSpaceError:
+        raise
     except Error as err:
-        errormsg(f"Failed to extract top layer: {err}")
+        errormsg(str(err))
         return (False, None, 0)
 
     if not version:
@@ -106,15 +214,54 @@ def make_tarball(
         stage_dir=stage_dir,
         patch_dirs=patch_dirs,
         dver=dver,
+        checkpoints=checkpoints,
+        debuginfo_mode=debuginfo_mode,
+        startup_profile=startup_profile,
+        seekable_output=seekable_output,
     ):
         errormsg(
             f"Making stage 2 tarball unsuccessful. "
             f"Files have been left in '{stage_dir}'. "
-            f"Image has been left as '{image_name}'."
+            f"Image has been left as '{image_name}'. "
+            f"Rerun with --resume to continue from the failed step."
         )
         return (False, None, 0)
     tarball_size = os.stat(tarball_name)[6]
 
+    statusmsg("Making size report")
+    try:
+        previous_report = None
+        if compare_dir:
+            previous_path = sizereport.find_previous_report(compare_dir, bundle, dver)
+            if previous_path:
+                previous_report = sizereport.read_report(previous_path)
+        report = sizereport.make_report(
+            stage_dir,
+            rpm_files=stage2.rpm_files_path(os.path.abspath(stage_dir)),
+            tarball=tarball_name,
+            bundle=bundle,
+            dver=dver,
+        )
+        sizereport.write_report(
+            report, sizereport.report_path_for_tarball(tarball_name)
+        )
+        sizereport.print_report(report)
+        if previous_report:
+            sizereport.print_report_diff(previous_report, report)
+    except Error as err:
+        errormsg(f"Warning: Failed to make size report: {err}")
+
+    if bundlecfg.has_option(bundle, "size_budget"):
+        size_budget = parse_size(bundlecfg.get(bundle, "size_budget"))
+        if tarball_size > size_budget:
+            errormsg(
+                f"{tarball_name} is {format_size(tarball_size)}, which is over "
+                f"the size budget of {format_size(size_budget)} for {bundle}. "
+                f"Files have been left in '{stage_dir}'. "
+                f"Image has been left as '{image_name}'."
+            )
+            return (False, None, 0)
+
     try:
         doc.do("rmi", image_name)
     except subprocess.CalledProcessError as err:
@@ -151,11 +298,88 @@ def parse_cmdline_args(argv):
         help="Select which OSG repo to use. (Default: %default)",
         choices=["production", "osg", "testing", "development"],
     )
+    parser.add_option(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Continue the previous, failed build of each bundle from the "
+        "first step that did not complete or whose inputs have changed",
+    )
+    parser.add_option(
+        "--compare-reports",
+        metavar="DIR",
+        default=".",
+        help="Compare each tarball's size report to the latest report for the "
+        "same bundle and dver in this directory. Default is %default.",
+    )
+    parser.add_option(
+        "--debuginfo",
+        dest="debuginfo_mode",
+        default="none",
+        choices=debuginfo.MODES,
+        help="What to do with the debug information in the ELF files: "
+        "'strip' moves it into a separate -debuginfo tarball, 'compress' "
+        "compresses it in place, 'none' leaves it alone. (Default: %default)",
+    )
+    parser.add_option(
+        "--layout",
+        default="filesystem",
+        choices=startupprofile.LAYOUTS,
+        help="Order of the files in the tarball: 'startup' puts the files "
+        "xrootd reads at startup first, using the bundle's profile in "
+        "startup-profiles/; 'filesystem' uses filesystem order. "
+        "(Default: %default)",
+    )
+    parser.add_option(
+        "--record-startup-profile",
+        action="store_true",
+        default=False,
+        help="Trace xrootd starting in the build image and save the files it "
+        "opens as the bundle's startup profile (implies --layout=startup)",
+    )
+    parser.add_option(
+        "--seekable",
+        dest="seekable_output",
+        action="store_true",
+        default=False,
+        help="Compress the tarball in independent frames and write an index "
+        "next to it, so single files can be read without downloading or "
+        "decompressing the whole tarball (see seekable.py).  The tarball "
+        "can still be extracted with tar.",
+    )
+    parser.add_option(
+        "--stage-dir",
+        dest="stage_dirs",
+        action="append",
+        default=[],
+        help="Scratch directory to stage builds and export images in. "
+        "May be specified multiple times; the one with the most free space "
+        "is used.  Default is the system temp dir and /var/tmp.",
+    )
+    parser.add_option(
+        "--tmpfs-dir",
+        default=staging.DEFAULT_TMPFS_DIR,
+        help="tmpfs directory to stage builds in if they fit the tmpfs "
+        "budget. Default is %default.",
+    )
+    parser.add_option(
+        "--tmpfs-budget",
+        default=None,
+        help="Largest stage dir to put on the tmpfs, e.g. 2G; 0 disables "
+        "staging in memory.  Default is half of the available memory.",
+    )
 
     options, args = parser.parse_args(argv[1:])
 
     if options.dver and options.dver not in VALID_DVERS:
         parser.error("--dver must be in " + ", ".join(VALID_DVERS))
+    if options.record_startup_profile:
+        options.layout = "startup"
+    if options.tmpfs_budget is not None:
+        try:
+            options.tmpfs_budget = parse_size(options.tmpfs_budget)
+        except ValueError as err:
+            parser.error(f"--tmpfs-budget: {err}")
 
     return (options, args)
 
@@ -168,7 +392,7 @@ def main(argv: Optional[list[str]] = None) -> int:
     options, args = parse_cmdline_args(argv)
 
     statusmsg("Checking required tools")
-    if not check_tools():
+    if not check_tools(options.debuginfo_mode):
         return 127
 
     bundlecfg = configparser.RawConfigParser()
@@ -187,8 +411,22 @@ def main(argv: Optional[list[str]] = None) -> int:
         errormsg("No bundles.  Exiting")
         return 1
 
-    failed_paramsets = []
-    written_tarballs = []
+    # Check the size budgets now rather than after a bundle has been built
+    for bundle in bundles:
+        if bundlecfg.has_option(bundle, "size_budget"):
+            try:
+                parse_size(bundlecfg.get(bundle, "size_budget"))
+            except ValueError as err:
+                errormsg(f"Invalid size_budget for {bundle}: {err}")
+                return 2
+
+    stager = staging.StagingManager(
+        scratch_dirs=options.stage_dirs,
+        tmpfs_dir=options.tmpfs_dir,
+        tmpfs_budget=options.tmpfs_budget,
+    )
+
+    jobs = []
     for bundle in bundles:
         dvers = set(bundlecfg.get(bundle, 'dvers').split())
         if options.dver:
@@ -201,39 +439,88 @@ def main(argv: Optional[list[str]] = None) -> int:
             continue
 
         for dver in sorted(dvers):
-            stage_dir_parent = tempfile.mkdtemp(prefix=f'stagedir-{dver}-')
-            stage_dir = Path(stage_dir_parent) / bundlecfg.get(bundle, 'dirname')
-
-            image_name = (
-                sanitize_image_tag(bundle)
-                + ":"
-                + sanitize_image_tag(
-                    os.path.basename(stage_dir_parent)[len('stagedir-') :]
-                )
-            )
+            job = None
+            if options.resume:
+                job = stager.find_job(bundle, dver)
+                if not job:
+                    statusmsg(f"No previous build of {bundle} for {dver} to resume")
+            jobs.append(job or stager.new_job(bundle, dver))
+    # end for bundle in options.bundles
 
-            patch_dirs: list[str] = []
-            if bundlecfg.has_option(bundle, 'patchdirs'):
-                patch_dirs = [
-                    os.path.join(prog_dir, x)
-                    for x in (
-                        bundlecfg.get(bundle, 'patchdirs') % {'dver': dver}
-                    ).split()
-                ]
+    failed_paramsets = []
+    written_tarballs = []
+    # Jobs that did not fit are retried once, after the other jobs are done
+    # and their stage dirs have been removed.
+    deferred_jobs = []
+    while jobs:
+        job = jobs.pop(0)
+        bundle, dver = job.bundle, job.dver
+
+        image_name = sanitize_image_tag(bundle) + ":" + sanitize_image_tag(job.name)
+
+        patch_dirs: list[str] = []
+        if bundlecfg.has_option(bundle, 'patchdirs'):
+            patch_dirs = [
+                os.path.join(prog_dir, x)
+                for x in (bundlecfg.get(bundle, 'patchdirs') % {'dver': dver}).split()
+            ]
+
+        startup_profile = None
+        if options.layout == "startup":
+            startup_profile = startupprofile.profile_path(prog_dir, bundle, dver)
+            if not options.record_startup_profile and not os.path.exists(
+                startup_profile
+            ):
+                default_profile = startupprofile.default_profile_path(prog_dir)
+                if os.path.exists(default_profile):
+                    statusmsg(
+                        f"{startup_profile} not found; using {default_profile}.  "
+                        f"Run with --record-startup-profile to make it."
+                    )
+                    startup_profile = default_profile
+                else:
+                    errormsg(
+                        f"Warning: {startup_profile} not found; using filesystem "
+                        f"order.  Run with --record-startup-profile to make it."
+                    )
+                    startup_profile = None
 
+        try:
             (success, tarball_path, tarball_size) = make_tarball(
                 bundlecfg=bundlecfg,
                 bundle=bundle,
                 dver=dver,
                 image_name=image_name,
                 patch_dirs=patch_dirs,
-                stage_dir=stage_dir,
+                stager=stager,
+                job=job,
                 osg_repo=options.osg_repo,
                 relnum=options.relnum,
                 version=options.version,
+                compare_dir=options.compare_reports,
+                debuginfo_mode=options.debuginfo_mode,
+                startup_profile=startup_profile,
+                record_startup_profile=options.record_startup_profile,
+                seekable_output=options.seekable_output,
             )
+        except staging.InsufficientSpaceError as err:
+            if job in deferred_jobs or not jobs:
+                errormsg(str(err))
+                failed_paramsets.append([bundle, dver])
+            else:
+                statusmsg(f"{err}; will retry after the remaining builds")
+                deferred_jobs.append(job)
+                jobs.append(job)
+            continue
 
-            if success and tarball_path is not None:
+        if success and tarball_path is not None:
+            new_tarballs = [(tarball_path, tarball_size)]
+            if options.debuginfo_mode == "strip":
+                debug_tarball_path = debuginfo.debuginfo_tarball_name(tarball_path)
+                new_tarballs.append(
+                    (debug_tarball_path, os.stat(debug_tarball_path)[6])
+                )
+            for tarball_path, tarball_size in new_tarballs:
                 tarball_filecount = "?"
                 try:
                     with os.popen(
@@ -242,20 +529,21 @@ def main(argv: Optional[list[str]] = None) -> int:
                         tarball_filecount = int(to_str(ph.read()))
                 except (OSError, ValueError) as e:
                     print("error getting file count: %s" % e)
-                written_tarballs.append([tarball_path, tarball_size, tarball_filecount])
+                written_tarballs.append(
+                    [tarball_path, tarball_size, tarball_filecount]
+                )
                 print(
                     "Tarball created as {0}, size {1:,} bytes, {2:,} files".format(
                         tarball_path, tarball_size, tarball_filecount
                     )
                 )
-            else:
-                failed_paramsets.append([bundle, dver])
-                continue
+        else:
+            failed_paramsets.append([bundle, dver])
+            continue
 
-            statusmsg("Removing temp dirs")
-            shutil.rmtree(stage_dir_parent, ignore_errors=True)
-        # end for dver in dvers
-    # end for bundle in options.bundles
+        statusmsg("Removing temp dirs")
+        stager.release(job)
+    # end while jobs
 
     if written_tarballs:
         statusmsg("The following tarballs were written:")
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""Module for writing and reading seekable tarballs
+
+A seekable tarball is an ordinary tar file compressed as a series of
+independent gzip members ("frames"), each holding about FRAME_SIZE bytes of
+the tar stream.  Concatenated gzip members are still a valid .tar.gz, so
+`tar -xzf` works on it as usual.  Frames are cut at the start of tar members
+where possible, so a small file can be read by decompressing one frame.
+
+Next to the tarball is an index (<tarball>.index.json.gz) that lists the
+frames (their offsets in the tar stream and in the compressed file) and the
+members (their type, mode, and the offset and size of their data in the tar
+stream).  With the index, SeekableTarball can list the members and read or
+extract individual ones by fetching only the frames they are in, from a
+local file or from an HTTP server that supports range requests.
+
+Usage:
+    seekable.py list <tarball path or URL>
+    seekable.py extract <tarball path or URL> <member>... [-C <dir>]
+"""
+
+import bisect
+import gzip
+import io
+import json
+import os
+import sys
+import tarfile
+import urllib.error
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from typing import IO, Any, Callable, Optional
+
+# make sure we can find our imports
+if __name__ == "__main__" and __package__ is None:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import Error, Pathable
+
+INDEX_SUFFIX = ".index.json.gz"
+INDEX_VERSION = 1
+
+# Uncompressed bytes per frame; smaller frames mean less to fetch for a single
+# file but compress worse.
+FRAME_SIZE = 1 << 20
+
+MEMBER_TYPES = {
+    tarfile.REGTYPE: "file",
+    tarfile.AREGTYPE: "file",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+}
+
+
+def index_path_for_tarball(tarball: str) -> str:
+    return tarball + INDEX_SUFFIX
+
+
+def _gzip_frame(data: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip format
+    return compressor.compress(data) + compressor.flush()
+
+
+class _FrameCutter(io.RawIOBase):
+    """
+    A file object for tarfile's stream mode that keeps the bytes read from
+    `fh` and cuts them into frames as soon as the frame boundaries are known,
+    passing each frame's data to `on_frame`, so the tar stream can be both
+    parsed and compressed as it is read.
+
+    A frame ends at the first member that starts at least FRAME_SIZE bytes
+    into it, or after FRAME_SIZE bytes if no member starts within the next
+    FRAME_SIZE bytes (that is, inside a large file).
+    """
+
+    def __init__(self, fh: IO[bytes], on_frame: Callable[[bytes], None]):
+        super().__init__()
+        self.fh = fh
+        self.on_frame = on_frame
+        self.buffer = bytearray()
+        self.buffer_offset = 0  # offset of buffer[0] (the current frame)
+        self.size = 0
+        # The data of the member being read, which no member starts inside of
+        self.data_start = 0
+        self.data_end = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self.fh.read(len(b))
+        b[: len(data)] = data
+        self.buffer += data
+        self.size += len(data)
+        # Don't wait for the next member to cut the frames of a large file
+        while True:
+            mark = self.buffer_offset + FRAME_SIZE
+            if (
+                mark > self.size
+                or mark < self.data_start
+                or mark + FRAME_SIZE > self.data_end
+            ):
+                break
+            self._cut(mark)
+        return len(data)
+
+    def _cut(self, end: int) -> None:
+        count = end - self.buffer_offset
+        self.on_frame(bytes(self.buffer[:count]))
+        del self.buffer[:count]
+        self.buffer_offset = end
+
+    def member(self, info: tarfile.TarInfo) -> None:
+        """Cut the frames that end at or before the start of a member"""
+        while info.offset - self.buffer_offset >= FRAME_SIZE:
+            mark = self.buffer_offset + FRAME_SIZE
+            self._cut(info.offset if info.offset < mark + FRAME_SIZE else mark)
+        self.data_start = info.offset_data
+        self.data_end = info.offset_data + info.size
+
+    def finish(self) -> None:
+        """Read the rest of the stream and cut the last frames"""
+        for _ in iter(lambda: self.read(1 << 20), b""):
+            pass  # the end-of-archive blocks and padding
+        while self.size - self.buffer_offset > FRAME_SIZE:
+            self._cut(self.buffer_offset + FRAME_SIZE)
+        self._cut(self.size)
+
+
+def write_seekable(tar_stream: IO[bytes], tarball: str) -> None:
+    """
+    Compress the uncompressed tar stream read from tar_stream into a seekable
+    tarball, and write its index.  The stream is compressed as it is read
+    (frames in parallel), so the uncompressed tar is never stored.
+    """
+    members: list[dict[str, Any]] = []
+    frames: list[list[int]] = []
+    pending: list[bytes] = []
+    batch_size = (os.cpu_count() or 1) * 4
+
+    try:
+        with open(tarball, "wb") as outfh, ThreadPoolExecutor() as executor:
+
+            def write_frames() -> None:
+                for chunk, frame in zip(pending, executor.map(_gzip_frame, pending)):
+                    outfh.write(frame)
+                    if frames:
+                        uncompressed_offset = frames[-1][0] + frames[-1][1]
+                        compressed_offset = frames[-1][2] + frames[-1][3]
+                    else:
+                        uncompressed_offset = compressed_offset = 0
+                    frames.append(
+                        [uncompressed_offset, len(chunk), compressed_offset, len(frame)]
+                    )
+                pending.clear()
+
+            def on_frame(chunk: bytes) -> None:
+                pending.append(chunk)
+                if len(pending) >= batch_size:
+                    write_frames()
+
+            cutter = _FrameCutter(tar_stream, on_frame)
+            with tarfile.open(fileobj=cutter, mode="r|") as tarh:
+                for info in tarh:
+                    cutter.member(info)
+                    members.append(
+                        {
+                            "name": info.name,
+                            "type": MEMBER_TYPES.get(info.type, "other"),
+                            "mode": info.mode,
+                            "mtime": info.mtime,
+                            "size": info.size,
+                            "offset": info.offset,
+                            "data_offset": info.offset_data,
+                            "linkname": info.linkname,
+                        }
+                    )
+            cutter.finish()
+            write_frames()
+
+        index = {
+            "version": INDEX_VERSION,
+            "tarball": os.path.basename(tarball),
+            "tar_size": cutter.size,
+            "frames": frames,
+            "members": members,
+        }
+        with gzip.open(index_path_for_tarball(tarball), "wt") as indexfh:
+            json.dump(index, indexfh)
+    except (OSError, tarfile.TarError) as err:
+        raise Error(f"Unable to write seekable tarball {tarball}: {err}") from err
+
+
+class _LocalSource:
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self, offset: int, length: Optional[int] = None) -> bytes:
+        with open(self.path, "rb") as fh:
+            fh.seek(offset)
+            return fh.read() if length is None else fh.read(length)
+
+
+class _HTTPSource:
+    def __init__(self, url: str):
+        self.url = url
+
+    def read(self, offset: int, length: Optional[int] = None) -> bytes:
+        request = urllib.request.Request(self.url)
+        if length is not None:
+            request.add_header("Range", f"bytes={offset}-{offset + length - 1}")
+        elif offset:
+            request.add_header("Range", f"bytes={offset}-")
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+            if (offset or length is not None) and response.status != 206:
+                # The server ignored the range; cut it out ourselves
+                end = None if length is None else offset + length
+                data = data[offset:end]
+        return data
+
+
+def _open_source(location: str):
+    if location.startswith(("http://", "https://")):
+        return _HTTPSource(location)
+    return _LocalSource(location)
+
+
+class SeekableTarball:
+    """
+    Random access to the members of a seekable tarball, which can be a local
+    path or an http(s) URL.  The index is fetched from next to the tarball
+    unless index_location is given.
+    """
+
+    def __init__(self, location: str, index_location: Optional[str] = None):
+        self.location = location
+        self._source = _open_source(location)
+        index_location = index_location or index_path_for_tarball(location)
+        try:
+            index = json.loads(
+                gzip.decompress(_open_source(index_location).read(0))
+            )
+        except (OSError, ValueError, urllib.error.URLError) as err:
+            raise Error(f"Unable to read index {index_location}: {err}") from err
+        if index.get("version") != INDEX_VERSION:
+            raise Error(f"Unsupported index version in {index_location}")
+        self.frames: list[list[int]] = index["frames"]
+        self._frame_starts = [x[0] for x in self.frames]
+        self._members: dict[str, dict[str, Any]] = {
+            x["name"].rstrip("/"): x for x in index["members"]
+        }
+
+    def names(self) -> list[str]:
+        return list(self._members)
+
+    def getmember(self, name: str) -> dict[str, Any]:
+        try:
+            return self._members[name.rstrip("/")]
+        except KeyError:
+            raise Error(f"{name} not found in {self.location}") from None
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        """Return `length` bytes of the uncompressed tar stream from `offset`"""
+        if length <= 0:
+            return b""
+        first = bisect.bisect_right(self._frame_starts, offset) - 1
+        last = bisect.bisect_right(self._frame_starts, offset + length - 1) - 1
+        start = self.frames[first][2]
+        end = self.frames[last][2] + self.frames[last][3]
+        try:
+            compressed = self._source.read(start, end - start)
+        except (OSError, urllib.error.URLError) as err:
+            raise Error(f"Unable to read from {self.location}: {err}") from err
+
+        data = b""
+        for frame in self.frames[first : last + 1]:
+            frame_start = frame[2] - start
+            try:
+                data += gzip.decompress(
+                    compressed[frame_start : frame_start + frame[3]]
+                )
+            except (OSError, EOFError, zlib.error) as err:
+                raise Error(f"Corrupt frame in {self.location}: {err}") from err
+        skip = offset - self.frames[first][0]
+        return data[skip : skip + length]
+
+    def read(self, name: str) -> bytes:
+        """Return the contents of a file in the tarball, following hard links"""
+        member = self.getmember(name)
+        if member["type"] == "hardlink":
+            member = self.getmember(member["linkname"])
+        if member["type"] != "file":
+            raise Error(f"{name} is not a regular file")
+        return self.read_range(member["data_offset"], member["size"])
+
+    def extract(self, name: str, path: Pathable = ".") -> str:
+        """
+        Extract a member (file, directory, or symlink) under `path`, creating
+        parent directories as needed.  Return the path it was extracted to.
+        """
+        member = self.getmember(name)
+        dest = os.path.join(path, member["name"].rstrip("/"))
+        if os.path.isabs(member["name"]) or ".." in member["name"].split("/"):
+            raise Error(f"Refusing to extract {name} outside of {path}")
+        # A symlink extracted earlier could point a parent dir elsewhere
+        real_path = os.path.realpath(path)
+        real_parent = os.path.realpath(os.path.dirname(dest) or ".")
+        if os.path.commonpath([real_path, real_parent]) != real_path:
+            raise Error(f"Refusing to extract {name} outside of {path}")
+        try:
+            os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+            if os.path.islink(dest):
+                # Replace it rather than write through it
+                os.unlink(dest)
+            if member["type"] == "dir":
+                os.makedirs(dest, exist_ok=True)
+            elif member["type"] == "symlink":
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+                os.symlink(member["linkname"], dest)
+                return dest
+            else:
+                with open(dest, "wb") as fh:
+                    fh.write(self.read(name))
+            os.chmod(dest, member["mode"])
+            os.utime(dest, (member["mtime"], member["mtime"]))
+        except OSError as err:
+            raise Error(f"Unable to extract {name} to {dest}: {err}") from err
+        return dest
+
+
+def main(argv):
+    parser = OptionParser(
+        """
+    %prog list <TARBALL>
+    %prog extract <TARBALL> <MEMBER>... [-C <DIR>]
+
+TARBALL can be a local path or an http(s) URL of a seekable tarball; its
+index is expected next to it.
+"""
+    )
+    parser.add_option(
+        "-C", "--directory", default=".", help="Extract into this directory"
+    )
+    options, args = parser.parse_args(argv[1:])
+    if len(args) < 2 or args[0] not in ("list", "extract"):
+        parser.error("Expected 'list' or 'extract' and a tarball")
+
+    try:
+        tarball = SeekableTarball(args[1])
+        if args[0] == "list":
+            for name in tarball.names():
+                print(name)
+        else:
+            for name in args[2:]:
+                print(tarball.extract(name, options.directory))
+    except Error as err:
+        print(f"Error: {err}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,261 @@
+"""Module for reporting how much each RPM contributes to the size of a tarball
+
+The files in the stage dir are matched up with the RPMs that own them, using
+the file list saved from the RPM database during the image build (the
+database itself is deleted before the layer is exported), and their
+installed size and gzipped size are added up per RPM and per directory.  The
+gzipped size of each file is measured by compressing it on its own, which
+slightly overestimates its share of the tarball, but is close enough to see
+which package grew.
+
+The report is saved as JSON next to the tarball so a later build can be
+compared against it.
+"""
+
+import json
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
+
+from common import Error, Pathable, format_size
+
+# Files are grouped into directories this many levels deep, e.g. usr/lib64
+DIRECTORY_DEPTH = 2
+
+# Owner for files that no RPM owns, e.g. the ones created by envsetup.py
+UNOWNED = "(unowned)"
+
+REPORT_SUFFIX = ".sizes.json"
+
+
+def report_path_for_tarball(tarball: Pathable) -> str:
+    return re.sub(r"\.tar(\.gz)?$", "", str(tarball)) + REPORT_SUFFIX
+
+
+def get_file_owners(rpm_files: Pathable) -> tuple[dict[str, list[str]], dict[str, str]]:
+    """
+    Read the files owned by each package from the file list saved during the
+    image build (see docker.RPM_QUERYFORMAT).  Returns a dict of the owners of
+    each path (relative to the root, since that's how they appear in the stage
+    dir), and a dict of the version-release of each package.
+    """
+    try:
+        with open(rpm_files, "r", errors="replace") as fh:
+            lines = fh.read().splitlines()
+    except OSError as err:
+        raise Error(f"Unable to read package file list {rpm_files}: {err}") from err
+    owners: dict[str, list[str]] = {}
+    versions: dict[str, str] = {}
+    for line in lines:
+        try:
+            name, version_release, filename = line.split("\t", 2)
+        except ValueError:
+            continue
+        versions[name] = version_release
+        owners.setdefault(filename.lstrip("/"), []).append(name)
+    return owners, versions
+
+
+def read_requested_packages(stage_dir: Pathable) -> set[str]:
+    """Return the names of the packages listed in portable-xrootd/versions.txt"""
+    try:
+        with open(os.path.join(stage_dir, "portable-xrootd", "versions.txt")) as fh:
+            return {
+                line.strip().rsplit("-", 2)[0] for line in fh if line.count("-") >= 2
+            }
+    except OSError:
+        return set()
+
+
+def compressed_size(path: Pathable) -> int:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # what gzip uses
+    size = 0
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+
+def _add(totals: dict[str, dict[str, Any]], key: str, installed, compressed, files):
+    entry = totals.setdefault(
+        key, {"installed_bytes": 0, "compressed_bytes": 0, "files": 0}
+    )
+    entry["installed_bytes"] += installed
+    entry["compressed_bytes"] += compressed
+    entry["files"] += files
+
+
+def make_report(
+    stage_dir: Pathable,
+    *,
+    rpm_files: Pathable,
+    tarball: Pathable,
+    bundle: str,
+    dver: str,
+) -> dict[str, Any]:
+    """
+    Build the size report for a stage dir, using the package file list at
+    rpm_files to find the owner of each file.  The bytes of a file owned by more
+    than one package are split evenly between them; hard links are counted
+    once.
+    """
+    owners, versions = get_file_owners(rpm_files)
+    requested = read_requested_packages(stage_dir)
+
+    files = []
+    seen_inodes = set()
+    for dirpath, _, filenames in os.walk(os.fspath(stage_dir)):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, stage_dir)
+            if relpath == "layer.tar":
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError as err:
+                raise Error(f"Unable to stat {path}: {err}") from err
+            if (st.st_dev, st.st_ino) in seen_inodes:
+                continue
+            seen_inodes.add((st.st_dev, st.st_ino))
+            files.append((path, relpath, st))
+
+    def measure(item) -> int:
+        path, _, st = item
+        if not os.path.isfile(path) or os.path.islink(path):
+            return st.st_size
+        try:
+            return compressed_size(path)
+        except OSError as err:
+            raise Error(f"Unable to read {path}: {err}") from err
+
+    with ThreadPoolExecutor() as executor:
+        compressed_sizes = list(executor.map(measure, files))
+
+    packages: dict[str, dict[str, Any]] = {}
+    directories: dict[str, dict[str, Any]] = {}
+    for (_, relpath, st), compressed in zip(files, compressed_sizes):
+        file_owners = owners.get(relpath, [UNOWNED])
+        for owner in file_owners:
+            _add(
+                packages,
+                owner,
+                st.st_size // len(file_owners),
+                compressed // len(file_owners),
+                1,
+            )
+        directory = "/".join(Path(relpath).parts[:-1][:DIRECTORY_DEPTH]) or "."
+        _add(directories, directory, st.st_size, compressed, 1)
+
+    for name, entry in packages.items():
+        entry["version"] = versions.get(name, "")
+        entry["requested"] = name in requested
+
+    return {
+        "bundle": bundle,
+        "dver": dver,
+        "tarball": os.path.basename(tarball),
+        "tarball_bytes": os.stat(tarball).st_size,
+        "installed_bytes": sum(st.st_size for _, _, st in files),
+        "compressed_bytes": sum(compressed_sizes),
+        "files": len(files),
+        "packages": packages,
+        "directories": directories,
+    }
+
+
+def write_report(report: dict[str, Any], path: Pathable) -> None:
+    try:
+        with open(path, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    except OSError as err:
+        raise Error(f"Unable to write size report {path}: {err}") from err
+
+
+def read_report(path: Pathable) -> dict[str, Any]:
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError) as err:
+        raise Error(f"Unable to read size report {path}: {err}") from err
+
+
+def find_previous_report(directory: Pathable, bundle: str, dver: str) -> Optional[str]:
+    """
+    Return the most recent size report in `directory` for the same bundle and
+    dver, or None if there is none.
+    """
+    candidates = []
+    for path in Path(directory).glob("*" + REPORT_SUFFIX):
+        try:
+            report = read_report(path)
+        except Error:
+            continue
+        if report.get("bundle") == bundle and report.get("dver") == dver:
+            candidates.append(path)
+    if not candidates:
+        return None
+    return str(max(candidates, key=lambda x: x.stat().st_mtime))
+
+
+def print_report(report: dict[str, Any], limit: int = 20) -> None:
+    print(
+        f"Installed size {format_size(report['installed_bytes'])}, "
+        f"compressed {format_size(report['compressed_bytes'])}, "
+        f"tarball {format_size(report['tarball_bytes'])}"
+    )
+    for title, key in [("Package", "packages"), ("Directory", "directories")]:
+        entries = sorted(
+            report[key].items(), key=lambda x: x[1]["compressed_bytes"], reverse=True
+        )
+        print(f"    {title:<40} {'installed':>14} {'compressed':>14} {'files':>7}")
+        for name, entry in entries[:limit]:
+            if entry.get("requested"):
+                name += " *"
+            print(
+                f"    {name:<40} {format_size(entry['installed_bytes']):>14} "
+                f"{format_size(entry['compressed_bytes']):>14} {entry['files']:>7,}"
+            )
+        if len(entries) > limit:
+            print(f"    ... and {len(entries) - limit} more")
+    print("    (* = package listed in versions.txt)")
+
+
+def print_report_diff(
+    old: dict[str, Any], new: dict[str, Any], limit: int = 20
+) -> None:
+    """Print the size changes between two reports, biggest changes first"""
+
+    def delta(old_bytes: int, new_bytes: int) -> str:
+        return f"{(new_bytes - old_bytes) / (1 << 20):+,.1f} MiB"
+
+    print(
+        f"Compared to {old['tarball']}: tarball "
+        f"{delta(old['tarball_bytes'], new['tarball_bytes'])}, installed "
+        f"{delta(old['installed_bytes'], new['installed_bytes'])}"
+    )
+    for title, key in [("Package", "packages"), ("Directory", "directories")]:
+        changes = []
+        for name in set(old[key]) | set(new[key]):
+            old_entry = old[key].get(name, {})
+            new_entry = new[key].get(name, {})
+            old_bytes = old_entry.get("compressed_bytes", 0)
+            new_bytes = new_entry.get("compressed_bytes", 0)
+            if old_bytes == new_bytes:
+                continue
+            label = name
+            if (
+                old_entry
+                and new_entry
+                and old_entry.get("version") != new_entry.get("version")
+            ):
+                label += f" ({old_entry['version']} -> {new_entry['version']})"
+            changes.append((new_bytes - old_bytes, label, old_bytes, new_bytes))
+        if not changes:
+            continue
+        changes.sort(key=lambda x: abs(x[0]), reverse=True)
+        print(f"    {title} (compressed)")
+        for _, label, old_bytes, new_bytes in changes[:limit]:
+            print(f"    {label:<60} {delta(old_bytes, new_bytes):>14}")
@@ -1,16 +1,33 @@
 import glob
+import hashlib
 import os
 import shlex
+import shutil
 import subprocess
-from typing import Any
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional
 
 import common
+import debuginfo
+import docker
+import seekable
+import startupprofile
+from checkpoint import Checkpoints, HashInput
 from common import (
     Error,
     Pathable,
     errormsg,
 )
 
+MANIFEST_FILE = os.path.join("portable-xrootd", "manifest.sha256")
+MANIFEST_SYMLINKS_FILE = os.path.join("portable-xrootd", "manifest.symlinks")
+
+# Where the list of files owned by each package is moved to after extraction,
+# relative to the stage dir parent, so it doesn't end up in the tarball
+RPM_FILES_FILE = "rpm-files.txt"
+
 
 def delete_wh_files_from_tarball(tarball: Pathable) -> None:
     """
@@ -37,6 +54,51 @@ def extract_layer_tarball(stage_dir_abs: Pathable, layer_tarball: Pathable):
         raise Error(f"Failed to extract layer tarball: {err}")
 
 
+def rpm_files_path(stage_dir_abs: Pathable) -> str:
+    return os.path.join(os.path.dirname(stage_dir_abs), RPM_FILES_FILE)
+
+
+def move_rpm_files(stage_dir_abs: Pathable) -> None:
+    """
+    Move the package file list saved by the image build out of the stage
+    dir.  Images built before it was saved don't have one.
+    """
+    path = os.path.join(stage_dir_abs, docker.RPM_FILES_PATH)
+    if not os.path.exists(path):
+        return
+    try:
+        shutil.move(path, rpm_files_path(stage_dir_abs))
+    except OSError as err:
+        raise Error(f"Unable to move {path} out of the stage dir: {err}") from err
+
+
+def clear_stage_dir(stage_dir_abs: Pathable, keep=("layer.tar",)) -> None:
+    """
+    Remove everything in the stage dir except the files named in `keep`, so
+    the layer can be extracted into it again.
+    """
+    fix_permissions(stage_dir_abs)
+    try:
+        for entry in os.scandir(os.fspath(stage_dir_abs)):
+            if entry.name in keep:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    except OSError as err:
+        raise Error(f"Failed to clear stage dir {stage_dir_abs}: {err}") from err
+
+
+def find_patch_files(patch_dirs) -> list[str]:
+    """Return the patch files in patch_dirs, in the order they are applied"""
+    patch_files = []
+    for patch_dir in patch_dirs:
+        patch_files += glob.glob(os.path.join(os.path.abspath(patch_dir), "*.patch"))
+    patch_files.sort(key=os.path.basename)
+    return patch_files
+
+
 def patch_installed_packages(stage_dir_abs, patch_dirs):
     """Apply all patches in patch_dir to the files in stage_dir_abs
 
@@ -50,15 +112,11 @@ def patch_installed_packages(stage_dir_abs, patch_dirs):
     Return success or failure as a bool
     """
 
-    patch_dirs_abs = [os.path.abspath(x) for x in patch_dirs]
+    patch_files = find_patch_files(patch_dirs)
 
     oldwd = os.getcwd()
     try:
         os.chdir(stage_dir_abs)
-        patch_files = []
-        for patch_dir_abs in patch_dirs_abs:
-            patch_files += glob.glob(os.path.join(patch_dir_abs, "*.patch"))
-        patch_files.sort(key=os.path.basename)
         for patch_file in patch_files:
             common.statusmsg("Applying patch %r" % patch_file)
             err = subprocess.call(['patch', '-p1', '--force', '--input', patch_file])
@@ -68,31 +126,161 @@ def patch_installed_packages(stage_dir_abs, patch_dirs):
         os.chdir(oldwd)
 
 
-def tar_stage_dir(stage_dir_abs, tarball):
+def tar_stage_dir(
+    stage_dir_abs,
+    tarball,
+    members: Optional[list[str]] = None,
+    seekable_output: bool = False,
+):
     """tar up the stage_dir
     Assume: valid stage2 dir
+    If `members` is given, it is the complete list of paths (relative to the
+    parent of the stage dir) to put in the tarball, in order; otherwise the
+    members are in filesystem order.
+    If `seekable_output` is set, the tarball is compressed in independent
+    frames and an index is written next to it (see seekable.py).
     """
     tarball_abs = os.path.abspath(tarball)
     stage_dir_parent = os.path.dirname(stage_dir_abs)
     stage_dir_base = os.path.basename(stage_dir_abs)
 
-    cmd = [
-        "tar",
-        "-C",
-        stage_dir_parent,
-        "--exclude=layer.tar",
-        "-czf",
-        tarball_abs,
-        stage_dir_base,
-    ]
-
-    err = subprocess.call(cmd)
+    if seekable_output:
+        # compressed below, as tar writes it
+        tar_output = ["-cf", "-"]
+    else:
+        tar_output = ["-czf", tarball_abs]
+
+    member_list = None
+    if members is None:
+        cmd = [
+            "tar",
+            "-C",
+            stage_dir_parent,
+            "--exclude=layer.tar",
+            *tar_output,
+            stage_dir_base,
+        ]
+    else:
+        cmd = [
+            "tar",
+            "-C",
+            stage_dir_parent,
+            "--no-recursion",
+            "--null",
+            "--verbatim-files-from",
+            "-T",
+            "-",
+            *tar_output,
+        ]
+        member_list = b"".join(os.fsencode(x) + b"\0" for x in members)
+
+    if seekable_output:
+        err = _tar_to_seekable(cmd, member_list, tarball_abs)
+    else:
+        err = subprocess.run(cmd, input=member_list).returncode
     if err:
         raise Error(
             f"unable to create tarball ({tarball_abs!r}) from stage 2 dir ({stage_dir_abs!r})"
         )
 
 
+def _tar_to_seekable(
+    cmd: list[str], member_list: Optional[bytes], tarball_abs: str
+) -> int:
+    """
+    Run a tar command that writes to stdout, and compress its output into a
+    seekable tarball as it is written, so the uncompressed tar is never
+    stored.  `member_list`, if given, is fed to tar's stdin.  Return tar's
+    exit code.
+    """
+
+    def feed(stdin) -> None:
+        try:
+            stdin.write(member_list)
+            stdin.close()
+        except OSError:
+            pass  # tar exited early; its exit code says why
+
+    stdin = subprocess.PIPE if member_list is not None else None
+    with subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE) as proc:
+        if member_list is not None:
+            # Written from another thread so tar can't block on a full stdout
+            threading.Thread(target=feed, args=(proc.stdin,), daemon=True).start()
+        assert proc.stdout is not None
+        seekable.write_seekable(proc.stdout, tarball_abs)
+    return proc.returncode
+
+
+def _sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _escape(text: str, escape_tabs: bool = False) -> str:
+    """
+    Backslash-escape backslashes and newlines (like sha256sum) in a manifest
+    field, and tabs too if escape_tabs is set
+    """
+    escaped = text.replace("\\", "\\\\").replace("\n", "\\n")
+    if escape_tabs:
+        escaped = escaped.replace("\t", "\\t")
+    return escaped
+
+
+def _manifest_line(digest: str, relpath: str) -> str:
+    # Escape the way sha256sum does, so `sha256sum -c` can read the manifest
+    if "\\" in relpath or "\n" in relpath:
+        return f"\\{digest}  {_escape(relpath)}\n"
+    return f"{digest}  {relpath}\n"
+
+
+def _symlink_line(target: str, relpath: str) -> str:
+    # The fields are tab-separated, so tabs are escaped too
+    return f"{_escape(target, True)}\t{_escape(relpath, True)}\n"
+
+
+def write_manifest(stage_dir_abs) -> None:
+    """
+    Write the hashes of the regular files in the stage dir to
+    portable-xrootd/manifest.sha256 (in `sha256sum` format) and the targets of
+    the symlinks to portable-xrootd/manifest.symlinks, for
+    portable-xrootd/verify to check an installed tree against.
+    Files are hashed in parallel.
+    """
+    manifest_paths = {MANIFEST_FILE, MANIFEST_SYMLINKS_FILE}
+    files = []
+    symlinks = []
+    for dirpath, dirnames, filenames in os.walk(stage_dir_abs):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, stage_dir_abs)
+            if relpath == "layer.tar" or relpath in manifest_paths:
+                continue
+            if os.path.islink(path):
+                symlinks.append((relpath, os.readlink(path)))
+            elif os.path.isfile(path):
+                files.append(relpath)
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            hashes = list(
+                executor.map(
+                    _sha256_file, [os.path.join(stage_dir_abs, x) for x in files]
+                )
+            )
+        with open(os.path.join(stage_dir_abs, MANIFEST_FILE), "w") as fh:
+            for relpath, digest in zip(files, hashes):
+                fh.write(_manifest_line(digest, relpath))
+        with open(os.path.join(stage_dir_abs, MANIFEST_SYMLINKS_FILE), "w") as fh:
+            for relpath, target in symlinks:
+                fh.write(_symlink_line(target, relpath))
+    except OSError as err:
+        raise Error(f"Unable to write manifest: {err}") from err
+
+
 def fix_permissions(stage_dir_abs):
     return subprocess.call(['chmod', '-R', 'u+rwX', stage_dir_abs])
 
@@ -132,36 +320,125 @@ def make_stage2_tarball(
     stage_dir: Pathable,
     patch_dirs: list[str],
     dver: str,
+    checkpoints: Optional[Checkpoints] = None,
+    debuginfo_mode: str = "none",
+    startup_profile: Optional[str] = None,
+    seekable_output: bool = False,
 ):
+    """
+    Run the stage 2 phases (whiteout cleanup, extraction, patching, debuginfo
+    stripping, and archiving) on an exported layer tarball.  Phases that
+    `checkpoints` shows as already complete are skipped.
+    If debuginfo_mode is "strip", the debug information is also written to
+    a companion tarball named by debuginfo.debuginfo_tarball_name().
+    If startup_profile is given, it is shipped in the tarball and the files
+    it lists are put first in the tarball.
+    If seekable_output is set, the tarball is written in the seekable format
+    with an index next to it.
+    Return success or failure as a bool
+    """
+
     def statusmsg(msg: Any):
         common.statusmsg(f"[{dver}]: {msg}")
 
     statusmsg(f"Making stage2 tarball in {stage_dir}")
 
     stage_dir_abs = os.path.abspath(stage_dir)
+    if checkpoints is None:
+        checkpoints = Checkpoints()
+    if isinstance(patch_dirs, str):
+        patch_dirs = [patch_dirs]
 
     try:
-        statusmsg("Deleting .wh. files from layer tarball")
-        delete_wh_files_from_tarball(layer_tarball_path)
+        if checkpoints.needed("whiteouts", outputs=[layer_tarball_path]):
+            statusmsg("Deleting .wh. files from layer tarball")
+            delete_wh_files_from_tarball(layer_tarball_path)
+            checkpoints.done("whiteouts")
+        else:
+            statusmsg("Skipping deleting .wh. files: already done")
 
-        statusmsg("Extracting layer tarball")
-        extract_layer_tarball(
-            stage_dir_abs=stage_dir_abs,
-            layer_tarball=os.path.abspath(layer_tarball_path),
+        need_extract = checkpoints.needed(
+            "extract", outputs=[os.path.join(stage_dir_abs, "portable-xrootd")]
         )
+        need_patch = checkpoints.needed(
+            "patch", *[Path(x) for x in find_patch_files(patch_dirs)]
+        )
+        need_debuginfo = checkpoints.needed("debuginfo", debuginfo_mode)
+        # Patching and stripping modify the extracted files in place, so they
+        # have to start from a fresh extraction.
+        need_rebuild = need_extract or need_patch or need_debuginfo
+        if need_rebuild:
+            statusmsg("Extracting layer tarball")
+            clear_stage_dir(stage_dir_abs)
+            extract_layer_tarball(
+                stage_dir_abs=stage_dir_abs,
+                layer_tarball=os.path.abspath(layer_tarball_path),
+            )
+            move_rpm_files(stage_dir_abs)
+            checkpoints.done("extract")
+        else:
+            statusmsg("Skipping extracting layer tarball: already done")
 
-        if patch_dirs:
-            if isinstance(patch_dirs, str):
-                patch_dirs = [patch_dirs]
+        if need_rebuild:
+            if patch_dirs:
+                statusmsg("Patching packages using %r" % patch_dirs)
+                patch_installed_packages(
+                    stage_dir_abs=stage_dir_abs, patch_dirs=patch_dirs
+                )
 
-            statusmsg("Patching packages using %r" % patch_dirs)
-            patch_installed_packages(stage_dir_abs=stage_dir_abs, patch_dirs=patch_dirs)
+            statusmsg("Fixing permissions")
+            fix_permissions(stage_dir_abs)
+            checkpoints.done("patch")
+        else:
+            statusmsg("Skipping patching packages: already done")
 
-        statusmsg("Fixing permissions")
-        fix_permissions(stage_dir_abs)
+        debug_stage_dir_abs = os.path.join(
+            os.path.dirname(stage_dir_abs),
+            "debuginfo",
+            os.path.basename(stage_dir_abs),
+        )
+        debug_tarball_name = debuginfo.debuginfo_tarball_name(tarball_name)
+        if need_rebuild:
+            if debuginfo_mode != "none":
+                statusmsg(f"Processing debug information ({debuginfo_mode})")
+                shutil.rmtree(debug_stage_dir_abs, ignore_errors=True)
+                if debuginfo_mode == "strip":
+                    common.safe_makedirs(debug_stage_dir_abs)
+                num_files = debuginfo.process_stage_dir(
+                    stage_dir_abs, debuginfo_mode, debug_stage_dir_abs
+                )
+                statusmsg(f"Processed debug information in {num_files} files")
+            checkpoints.done("debuginfo")
+        else:
+            statusmsg("Skipping processing debug information: already done")
 
-        statusmsg("Creating tarball %r" % tarball_name)
-        tar_stage_dir(stage_dir_abs, tarball_name)
+        archive_outputs = [tarball_name]
+        if seekable_output:
+            archive_outputs.append(seekable.index_path_for_tarball(tarball_name))
+        if debuginfo_mode == "strip":
+            archive_outputs.append(debug_tarball_name)
+        archive_inputs: list[HashInput] = list(archive_outputs)
+        if startup_profile:
+            archive_inputs.append(Path(startup_profile))
+        if checkpoints.needed("archive", *archive_inputs, outputs=archive_outputs):
+            members = None
+            if startup_profile:
+                startupprofile.ship_profile(startup_profile, stage_dir_abs)
+            statusmsg("Writing file manifest")
+            write_manifest(stage_dir_abs)
+            if startup_profile:
+                statusmsg("Ordering tarball members by %r" % startup_profile)
+                members = startupprofile.ordered_members(
+                    stage_dir_abs, startupprofile.read_profile(startup_profile)
+                )
+            statusmsg("Creating tarball %r" % tarball_name)
+            tar_stage_dir(stage_dir_abs, tarball_name, members, seekable_output)
+            if debuginfo_mode == "strip":
+                statusmsg("Creating debuginfo tarball %r" % debug_tarball_name)
+                tar_stage_dir(debug_stage_dir_abs, debug_tarball_name)
+            checkpoints.done("archive")
+        else:
+            statusmsg("Skipping creating tarball: already done")
 
         return True
     except Error as err:
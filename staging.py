@@ -0,0 +1,247 @@
+"""Module for deciding where each build job is staged
+
+A job needs room in three places:
+
+- the export dir, where `docker save` writes the whole image before the top
+  layer is pulled out of it;
+- the stage dir, which holds the top layer tarball (layer.tar) and the tree
+  extracted from it;
+- the current directory, where the final tarball is written.
+
+The sizes are estimated from the image once it has been built, before
+anything is exported or extracted.  If the stage dir fits within the memory
+budget, it is put on a tmpfs, which avoids most of the disk I/O of stage 2;
+otherwise it is put on whichever scratch disk has the most free space.  Jobs
+that do not fit anywhere are refused with InsufficientSpaceError, so the
+caller can retry them later or give up, instead of failing partway through
+the export.
+"""
+
+import os
+import secrets
+import shutil
+import tempfile
+from pathlib import Path
+from typing import NamedTuple, Optional, Sequence
+
+import docker
+from checkpoint import CHECKPOINT_FILE, Checkpoints
+from common import Error, Pathable, format_size
+
+DEFAULT_TMPFS_DIR = "/dev/shm"
+
+# Multiplier applied to the space estimates, to leave some slack for the files
+# that get added during stage 2 and for filesystem overhead.
+SPACE_HEADROOM = 1.1
+
+
+class InsufficientSpaceError(Error):
+    pass
+
+
+def available_memory() -> int:
+    """
+    Return the amount of physical memory that is currently available, in bytes,
+    or 0 if it cannot be determined.
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def default_scratch_dirs() -> list[str]:
+    dirs = [tempfile.gettempdir()]
+    if "/var/tmp" not in dirs and os.path.isdir("/var/tmp"):
+        dirs.append("/var/tmp")  # /var/tmp is usually bigger than /tmp
+    return dirs
+
+
+class SpaceEstimate(NamedTuple):
+    layer_bytes: int
+    image_bytes: int
+
+    @property
+    def stage_bytes(self) -> int:
+        # layer.tar plus the tree extracted from it
+        return 2 * self.layer_bytes
+
+    @property
+    def export_bytes(self) -> int:
+        return self.image_bytes
+
+    @property
+    def output_bytes(self) -> int:
+        # The compressed tarball is smaller than the layer; this is an
+        # upper bound.
+        return self.layer_bytes
+
+
+class StageJob:
+    """
+    A single bundle/dver build.  The name is chosen up front (the image is
+    tagged with it); the directories are only set once the job has been
+    placed.
+    """
+
+    def __init__(self, bundle: str, dver: str, name: str = ""):
+        self.bundle = bundle
+        self.dver = dver
+        self.name = name or f"{dver}-{secrets.token_hex(4)}"
+        self.path: Optional[Path] = None
+        self.export_dir: Optional[Path] = None
+        self.on_tmpfs = False
+
+    @property
+    def dirname(self) -> str:
+        return f"stagedir-{self.name}"
+
+
+class StagingManager:
+    def __init__(
+        self,
+        scratch_dirs: Sequence[Pathable] = (),
+        tmpfs_dir: Optional[Pathable] = DEFAULT_TMPFS_DIR,
+        tmpfs_budget: Optional[int] = None,
+    ):
+        """
+        Arguments:
+            scratch_dirs: Disk directories to stage in and export images to.
+                Defaults to the system temp dir and /var/tmp.
+            tmpfs_dir: A directory on a tmpfs to stage small jobs in, or None
+                to never stage in memory.
+            tmpfs_budget: The largest stage dir, in bytes, to put on the
+                tmpfs.  Defaults to half of the currently available memory.
+        """
+        self.scratch_dirs = [Path(x) for x in (scratch_dirs or default_scratch_dirs())]
+        self.tmpfs_dir = Path(tmpfs_dir) if tmpfs_dir else None
+        if self.tmpfs_dir and not self.tmpfs_dir.is_dir():
+            self.tmpfs_dir = None
+        if tmpfs_budget is None:
+            tmpfs_budget = available_memory() // 2
+        self.tmpfs_budget = tmpfs_budget
+
+    def new_job(self, bundle: str, dver: str) -> StageJob:
+        return StageJob(bundle, dver)
+
+    def find_job(self, bundle: str, dver: str) -> Optional[StageJob]:
+        """
+        Find the stage dir left behind by an earlier, failed build of the
+        bundle for the dver, so it can be resumed.  If there is more than one,
+        the most recently modified is used.  Returns None if there are none.
+        """
+        roots = ([self.tmpfs_dir] if self.tmpfs_dir else []) + self.scratch_dirs
+        found = []
+        for root in roots:
+            for path in root.glob(f"stagedir-{dver}-*"):
+                checkpoint_path = path / CHECKPOINT_FILE
+                if not checkpoint_path.is_file():
+                    continue
+                try:
+                    data = Checkpoints.read(checkpoint_path)
+                except Error:
+                    continue
+                if data.get("bundle") == bundle and data.get("dver") == dver:
+                    found.append(path)
+        if not found:
+            return None
+
+        path = max(found, key=lambda x: x.stat().st_mtime)
+        job = StageJob(bundle, dver, name=path.name[len("stagedir-") :])
+        job.path = path
+        job.on_tmpfs = path.parent == self.tmpfs_dir
+        if job.on_tmpfs:
+            scratch_dirs = [x for x in self.scratch_dirs if x.is_dir()]
+            job.export_dir = max(
+                scratch_dirs, key=lambda x: shutil.disk_usage(x).free, default=None
+            )
+        else:
+            job.export_dir = path.parent
+        return job
+
+    def estimate(self, image: str) -> SpaceEstimate:
+        """
+        Estimate the space needed to stage the given (already built) image.
+        If the size of the top layer cannot be determined, the size of the
+        entire image is used instead, which overestimates.
+        """
+        doc = docker.Docker()
+        image_bytes = doc.image_size(image)
+        try:
+            layer_bytes = doc.top_layer_size(image)
+        except Error:
+            layer_bytes = image_bytes
+        return SpaceEstimate(layer_bytes=layer_bytes, image_bytes=image_bytes)
+
+    def _fits(self, needs: dict[Path, int]) -> bool:
+        """
+        Return True if every directory in `needs` has room for the number of
+        bytes it is mapped to.  Directories that are on the same filesystem
+        have their needs added up.
+        """
+        needs_by_dev: dict[int, int] = {}
+        free_by_dev: dict[int, int] = {}
+        for path, num_bytes in needs.items():
+            try:
+                dev = os.stat(path).st_dev
+                free_by_dev[dev] = shutil.disk_usage(path).free
+            except OSError:
+                return False
+            needs_by_dev[dev] = needs_by_dev.get(dev, 0) + int(
+                num_bytes * SPACE_HEADROOM
+            )
+        return all(needs_by_dev[dev] <= free_by_dev[dev] for dev in needs_by_dev)
+
+    def place(
+        self, job: StageJob, estimate: SpaceEstimate, output_dir: Pathable = "."
+    ) -> None:
+        """
+        Pick the stage dir and export dir for a job and create the stage dir.
+        The tmpfs is preferred if the job fits the memory budget.  Raises
+        InsufficientSpaceError if there is nowhere with enough room.
+        """
+        output_path = Path(output_dir).absolute()
+        # Try the scratch dirs with the most free space first
+        scratch_dirs = sorted(
+            (x for x in self.scratch_dirs if x.is_dir()),
+            key=lambda x: shutil.disk_usage(x).free,
+            reverse=True,
+        )
+
+        candidates: list[tuple[Path, Path, bool]] = []
+        if self.tmpfs_dir and estimate.stage_bytes <= self.tmpfs_budget:
+            candidates += [(self.tmpfs_dir, x, True) for x in scratch_dirs]
+        candidates += [(x, x, False) for x in scratch_dirs]
+
+        for stage_root, export_dir, on_tmpfs in candidates:
+            if on_tmpfs:
+                needs = {
+                    stage_root: estimate.stage_bytes,
+                    export_dir: estimate.export_bytes,
+                }
+            else:
+                # The exported image is deleted before the layer is extracted,
+                # so the most that's on disk at once is the image plus
+                # layer.tar.
+                needs = {
+                    stage_root: estimate.export_bytes + estimate.layer_bytes,
+                }
+            needs[output_path] = needs.get(output_path, 0) + estimate.output_bytes
+            if self._fits(needs):
+                job.path = stage_root / job.dirname
+                job.path.mkdir(mode=0o700)
+                job.export_dir = export_dir
+                job.on_tmpfs = on_tmpfs
+                return
+
+        raise InsufficientSpaceError(
+            f"Not enough space to stage {job.bundle} for {job.dver}: need about "
+            f"{format_size(estimate.stage_bytes)} to stage and "
+            f"{format_size(estimate.export_bytes)} to export the image"
+        )
+
+    def release(self, job: StageJob) -> None:
+        """Remove the stage dir of a job"""
+        if job.path:
+            shutil.rmtree(job.path, ignore_errors=True)
+            job.path = None
@@ -0,0 +1,225 @@
+"""Module for ordering the files in a tarball by when XRootD reads them at startup
+
+A startup profile is the list of files that xrootd opens while it starts,
+in the order it first opens them.  It is recorded by running xrootd under
+strace in an image with the bundle's packages installed but not yet cleaned
+up (see docker.TRACE_STAGE_TEMPLATE), with a config that loads the plugins
+the tarballs are meant for (scitokens, voms, multiuser), and is saved in the
+startup-profiles directory so it can be reviewed and refreshed each release.
+Bundles without a recorded profile use startup-profiles/default.txt, which
+lists the main files as shell-style patterns.
+
+When the tarball is made with the "startup" layout, the files in the profile
+are put right after the directories, ahead of everything else, so that
+extracting and starting xrootd from a cold cache reads mostly sequentially.
+A copy of the profile is shipped as portable-xrootd/startup-profile.txt.
+"""
+
+import fnmatch
+import os
+import re
+import shutil
+from typing import Optional
+
+import docker
+from common import Error, Pathable, safe_makedirs
+
+LAYOUTS = ["filesystem", "startup"]
+
+PROFILE_DIR = "startup-profiles"
+DEFAULT_PROFILE = "default.txt"
+PROFILE_SHIPPED_PATH = os.path.join("portable-xrootd", "startup-profile.txt")
+
+# A recorded profile that does not include these was not made from a
+# complete startup
+REQUIRED_PLUGINS = ["libXrdAccSciTokens", "libXrdVoms", "libXrdMultiuser"]
+
+# How long to let xrootd start up while tracing it
+TRACE_SECONDS = 15
+
+TRACE_CONFIG = r"""
+all.adminpath /tmp/xrootd-trace
+all.pidpath /tmp/xrootd-trace
+all.export /tmp
+xrd.port 1094
+xrd.protocol XrdHttp:8080 libXrdHttp.so
+xrootd.seclib libXrdSec.so
+sec.protocol ztn
+sec.protocol gsi -certdir:/tmp/xrootd-trace/certs -cert:/tmp/xrootd-trace/hostcert.pem -key:/tmp/xrootd-trace/hostkey.pem -ca:0 -crl:0 -vomsfun:libXrdVoms.so
+ofs.authorize 1
+ofs.authlib ++ libXrdAccSciTokens.so
+ofs.osslib ++ libXrdMultiuser.so
+ofs.ckslib ++ libXrdMultiuser.so
+"""
+
+TRACE_SCRIPT = r"""
+mkdir -p /tmp/xrootd-trace/certs
+# gsi (and so the voms plugin) is only loaded if there is a host cert
+openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost \
+    -keyout /tmp/xrootd-trace/hostkey.pem -out /tmp/xrootd-trace/hostcert.pem \
+    >/dev/null 2>&1 || exit 1
+chmod 0400 /tmp/xrootd-trace/hostkey.pem
+chown -R xrootd: /tmp/xrootd-trace
+cat > /tmp/xrootd-trace.cfg <<'EOF'
+{config}
+EOF
+timeout -s INT {seconds} strace -f -qq -e trace=execve,open,openat \
+    -o /tmp/xrootd-trace.out \
+    xrootd -R xrootd -c /tmp/xrootd-trace.cfg -l /tmp/xrootd-trace/xrootd.log \
+    >/dev/null 2>&1
+cat /tmp/xrootd-trace.out
+"""
+
+# Resolves symlinks (e.g. /lib64 -> usr/lib64) to the paths in the stage dir
+REALPATH_SCRIPT = r"""
+import os, sys
+for line in sys.stdin:
+    print(os.path.realpath(line.rstrip("\n")))
+"""
+
+# e.g. `1234  openat(AT_FDCWD, "/usr/lib64/libXrdUtils.so.3", O_RDONLY|O_CLOEXEC) = 3`
+TRACE_LINE_RE = re.compile(
+    r'^\d+\s+(?:execve|open|openat)\((?:AT_FDCWD, )?"([^"]+)".*\)\s+=\s+\d+'
+)
+
+# Accesses outside the installed tree that are not worth recording
+IGNORED_PREFIXES = ("/proc/", "/sys/", "/dev/", "/tmp/", "/run/")
+
+
+def profile_path(prog_dir: Pathable, bundle: str, dver: str) -> str:
+    return os.path.join(prog_dir, PROFILE_DIR, f"{bundle}-{dver}.txt")
+
+
+def default_profile_path(prog_dir: Pathable) -> str:
+    return os.path.join(prog_dir, PROFILE_DIR, DEFAULT_PROFILE)
+
+
+def parse_trace(trace: str) -> list[str]:
+    """Return the files successfully opened in an strace log, in first-open order"""
+    paths: dict[str, None] = {}
+    for line in trace.splitlines():
+        match = TRACE_LINE_RE.match(line)
+        if not match:
+            continue
+        path = os.path.normpath(match.group(1))
+        if path.startswith("/") and not path.startswith(IGNORED_PREFIXES):
+            paths.setdefault(path, None)
+    return list(paths)
+
+
+def record_startup_profile(image: str, seconds: int = TRACE_SECONDS) -> list[str]:
+    """
+    Start xrootd under strace in the image (built from the trace stage) and
+    return the files it opened, in order.  Symlinks are followed; both the
+    symlink and its target are listed.  Raises Error if any of
+    REQUIRED_PLUGINS was not loaded.
+    """
+    doc = docker.Docker()
+    script = TRACE_SCRIPT.format(config=TRACE_CONFIG.strip(), seconds=seconds)
+    trace = doc.output("run", "--rm", "--cap-add=SYS_PTRACE", image, "sh", "-c", script)
+    opened = parse_trace(trace)
+    if not opened:
+        raise Error(f"No file accesses recorded from starting xrootd in {image}")
+    opened_names = [os.path.basename(x) for x in opened]
+    missing = [
+        plugin
+        for plugin in REQUIRED_PLUGINS
+        if not any(x.startswith(plugin) for x in opened_names)
+    ]
+    if missing:
+        raise Error(
+            f"xrootd did not load {', '.join(missing)} while starting in {image}; "
+            f"the startup profile would be incomplete"
+        )
+
+    resolved = doc.output(
+        "run",
+        "--rm",
+        "-i",
+        image,
+        "python3",
+        "-c",
+        REALPATH_SCRIPT,
+        input="\n".join(opened) + "\n",
+    ).splitlines()
+    paths: dict[str, None] = {}
+    for path, realpath in zip(opened, resolved):
+        paths.setdefault(realpath, None)
+        paths.setdefault(path, None)
+    return list(paths)
+
+
+def write_profile(paths: list[str], path: Pathable, image: str) -> None:
+    try:
+        safe_makedirs(os.path.dirname(os.path.abspath(path)))
+        with open(path, "w") as fh:
+            fh.write(f"# Files opened while starting xrootd in {image}, in order.\n")
+            fh.write("# Regenerate with main.py --record-startup-profile.\n")
+            for line in paths:
+                fh.write(line + "\n")
+    except OSError as err:
+        raise Error(f"Unable to write startup profile {path}: {err}") from err
+
+
+def read_profile(path: Pathable) -> list[str]:
+    try:
+        with open(path, "r") as fh:
+            return [
+                line.strip()
+                for line in fh
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    except OSError as err:
+        raise Error(f"Unable to read startup profile {path}: {err}") from err
+
+
+def ship_profile(profile: Pathable, stage_dir_abs: Pathable) -> None:
+    """Copy the profile into the stage dir so it is included in the tarball"""
+    try:
+        shutil.copyfile(profile, os.path.join(stage_dir_abs, PROFILE_SHIPPED_PATH))
+    except OSError as err:
+        raise Error(f"Unable to copy startup profile into stage dir: {err}") from err
+
+
+def ordered_members(
+    stage_dir_abs: Pathable, profile: Optional[list[str]] = None
+) -> list[str]:
+    """
+    Return the paths to put in the tarball, relative to the parent of the
+    stage dir: the stage dir and every directory under it first, then the
+    files in the profile in profile order, then everything else.  Profile
+    entries can be shell-style patterns; the files matching a pattern are
+    put in filesystem order.
+    """
+    stage_dir_abs = os.fspath(stage_dir_abs)
+    stage_dir_base = os.path.basename(stage_dir_abs)
+    directories = [stage_dir_base]
+    others = []
+    for dirpath, dirnames, filenames in os.walk(stage_dir_abs):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, stage_dir_abs)
+        if relpath == ".":
+            reldir = stage_dir_base
+        else:
+            reldir = os.path.join(stage_dir_base, relpath)
+        for dirname in dirnames:
+            path = os.path.join(reldir, dirname)
+            if os.path.islink(os.path.join(dirpath, dirname)):
+                others.append(path)
+            else:
+                directories.append(path)
+        for filename in sorted(filenames):
+            if reldir == stage_dir_base and filename == "layer.tar":
+                continue
+            others.append(os.path.join(reldir, filename))
+
+    hot: dict[str, None] = {}
+    present = set(others)
+    for path in profile or []:
+        member = os.path.join(stage_dir_base, path.lstrip("/"))
+        if any(x in member for x in "*?["):
+            for match in fnmatch.filter(others, member):
+                hot.setdefault(match, None)
+        elif member in present:
+            hot.setdefault(member, None)
+    return directories + list(hot) + [x for x in others if x not in hot]